@@ -1,8 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from face_swapper import FaceSwapProcessor
+from face_swapper import FaceSwapProcessor, download_models, WORKERS
 import uvicorn
+import asyncio
 import json
+import os
+from urllib.parse import unquote
+
+# Configuration
+MAX_CONCURRENT_SWAPS = int(os.environ.get("MAX_CONCURRENT_SWAPS", 2))
 
 class FaceSwapResult(BaseModel):
     """Result model for face swap operation"""
@@ -25,10 +32,19 @@ class FaceSwapRequest(BaseModel):
     target_image_base64: str
 
 app = FastAPI(title="Callback API", 
-              description="API for receiving callbacks from the processing API")
+              description="API for receiving callbacks from the processing API",
+              default_response_class=ORJSONResponse)
 
 face_swapper_instance = FaceSwapProcessor()
 
+# Caps in-flight face swaps per worker so bursts of multi-MB images don't exhaust memory
+swap_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SWAPS)
+
+@app.on_event("startup")
+async def load_models():
+    """Load and warm up models before the first request arrives"""
+    face_swapper_instance.initialize_face_swap()
+
 @app.post("/callback/test-image")
 async def receive_test_image_callback(result: TestImageResult):
     """Endpoint that receives callbacks from the test image processing API"""
@@ -88,14 +104,75 @@ async def receive_face_swap_callback(result: FaceSwapResult):
             "request_id": result.request_id
         }
 
+@app.post("/callback/face-swap/binary")
+async def receive_face_swap_binary_callback(request: Request):
+    """
+    Endpoint that receives face swap callbacks as raw JPEG bytes.
+    
+    Status and request_id arrive in the X-Status and X-Request-Id headers,
+    so no base64 decoding or JSON parsing is needed.
+    """
+    status = request.headers.get("X-Status", "")
+    request_id = request.headers.get("X-Request-Id")
+    print(f"Binary face swap callback received with status: {status}, request_id: {request_id}")
+    
+    image_bytes = await request.body()
+    if status == "success" and image_bytes:
+        print(f"Face swap completed successfully ({len(image_bytes)} bytes)")
+        return {
+            "message": "Face swap callback received",
+            "status": status,
+            "swapped_image_size": len(image_bytes),
+            "request_id": request_id
+        }
+    elif status == "failed":
+        error = unquote(request.headers.get("X-Error", ""))
+        print(f"Error: {error}")
+        return {
+            "message": "Face swap callback received", 
+            "status": status, 
+            "error": error, 
+            "request_id": request_id
+        }
+    else:
+        return {
+            "message": "Face swap callback received", 
+            "status": status, 
+            "request_id": request_id
+        }
+
 @app.post("/direct")
 async def direct_face_swap(request: FaceSwapRequest):
     """Endpoint for direct/synchronous face swap operations"""
     try:
-        # Use the face swapper directly
-        swapped_base64 = face_swapper_instance.face_swap_function(
-            request.source_image_base64, request.target_image_base64
-        )
+        # Use the face swapper directly, off the event loop
+        async with swap_semaphore:
+            swapped_base64 = await asyncio.to_thread(
+                face_swapper_instance.face_swap_function,
+                request.source_image_base64, request.target_image_base64
+            )
+        return {
+            "status": "success", 
+            "swapped_image_base64": swapped_base64,
+            "message": "Face swap completed successfully"
+        }
+    except Exception as e:
+        return {
+            "status": "failed", 
+            "error": str(e),
+            "message": "Face swap failed"
+        }
+
+@app.post("/direct/upload")
+async def direct_face_swap_upload(source_image: UploadFile = File(...), target_image: UploadFile = File(...)):
+    """Multipart variant of /direct that takes raw image files instead of base64 JSON"""
+    try:
+        source_bytes = await source_image.read()
+        target_bytes = await target_image.read()
+        async with swap_semaphore:
+            swapped_base64 = await asyncio.to_thread(
+                face_swapper_instance.face_swap_bytes, source_bytes, target_bytes
+            )
         return {
             "status": "success", 
             "swapped_image_base64": swapped_base64,
@@ -125,4 +202,6 @@ async def test_compat(result: FaceSwapResult):
     return await receive_face_swap_callback(result)
 
 if __name__ == "__main__":
-    uvicorn.run(app, port=8000, host="127.0.0.1")
+    # Download model files once so workers don't race on the same paths
+    download_models()
+    uvicorn.run("callback_api:app", port=8000, host="127.0.0.1", workers=WORKERS)
@@ -1,36 +1,140 @@
-import base64
-import numpy as np
 import os
+
+# Her uvicorn worker'ı kendi süreci olduğundan, kütüphanelerin CPU sayısı
+# kadar thread açıp birbirini ezmemesi için thread sayılarını sınırla.
+# numpy/cv2 import edilmeden önce ayarlanmalı.
+os.environ.setdefault("OMP_NUM_THREADS", "2")
+os.environ.setdefault("MKL_NUM_THREADS", "2")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "2")
+CPU_THREADS = int(os.environ["OMP_NUM_THREADS"])
+# Paralellik thread'lerden değil süreçlerden gelir: CPU_THREADS çekirdek başına bir worker
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", max(1, (os.cpu_count() or 2) // CPU_THREADS)))
+
+import pybase64
+import numpy as np
+import threading
+from collections import OrderedDict
+from blake3 import blake3
 import cv2
-import insightface
-from insightface.app import FaceAnalysis
+import onnxruntime
+from insightface.app.common import Face
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.model_zoo.retinaface import RetinaFace
+from insightface.utils import ensure_available
 import gdown
 
+cv2.setNumThreads(CPU_THREADS)
+
+DET_SIZE = (640, 640)
+# buffalo_l paketinden sadece algılama ve ArcFace modelleri kullanılır
+DET_MODEL_FILE = "det_10g.onnx"
+REC_MODEL_FILE = "w600k_r50.onnx"
+JPEG_ENCODE_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+SOURCE_FACE_CACHE_SIZE = 256
+# Kaynak resmin en uzun kenarı için üst sınır (0: sınırsız)
+MAX_IMAGE_SIZE = int(os.environ.get("MAX_IMAGE_SIZE", 1280))
+# Hedef resim çıktının kendisi olduğu için varsayılan olarak küçültülmez
+# (0: sınırsız); ayarlanırsa çıktı çözünürlüğü de düşer
+MAX_TARGET_IMAGE_SIZE = int(os.environ.get("MAX_TARGET_IMAGE_SIZE", 0))
+
+def get_execution_providers():
+    """CUDA mevcutsa onu, değilse CPU'yu kullanan ONNX Runtime provider listesi"""
+    providers = []
+    if 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+        providers.append(('CUDAExecutionProvider', {
+            'cudnn_conv_algo_search': 'HEURISTIC',
+            'do_copy_in_default_stream': True,
+        }))
+    providers.append('CPUExecutionProvider')
+    return providers
+
+def create_session(model_path, providers):
+    """Tam graf optimizasyonlu ve CPU_THREADS ile sınırlı bir ONNX Runtime oturumu açar"""
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.intra_op_num_threads = CPU_THREADS
+    sess_options.inter_op_num_threads = 1
+    return onnxruntime.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+
+def download_models():
+    """
+    buffalo_l ve inswapper modellerini yoksa indirir.
+    
+    Birden fazla uvicorn worker'ı aynı dosyalara aynı anda indirmesin diye
+    sunucu başlatılmadan önce ana süreçte bir kez çağrılmalı.
+    
+    Returns:
+        tuple: (buffalo_l model klasörü, inswapper model yolu)
+    """
+    buffalo_dir = ensure_available('models', 'buffalo_l', root='~/.insightface')
+    
+    model_path = os.path.join(os.path.dirname(__file__), "inswapper_128.onnx")
+    if not os.path.exists(model_path):
+        file_id = '1krOLgjW2tAPaqV-Bw4YALz0xT5zlb5HF'
+        url = f'https://drive.google.com/uc?id={file_id}'
+        gdown.download(url, model_path, quiet=False)
+    else:
+        print("Inswapper modeli mevcut.")
+    return buffalo_dir, model_path
+
 class FaceSwapProcessor:
     """Face swap processor class"""
     
     def __init__(self):
-        self.app = None
+        self.det_model = None
+        self.rec_model = None
         self.swapper = None
         self.is_initialized = False
+        self._source_face_cache = OrderedDict()
+        self._source_face_lock = threading.Lock()
     
     def initialize_face_swap(self):
         """Initialize face swap models"""
-        self.app = FaceAnalysis(name='buffalo_l')
-        self.app.prepare(ctx_id=0, det_size=(640, 640))
-        
-        model_path = os.path.join(os.path.dirname(__file__), "inswapper_128.onnx")
-        if not os.path.exists(model_path):
-            file_id = '1krOLgjW2tAPaqV-Bw4YALz0xT5zlb5HF'
-            url = f'https://drive.google.com/uc?id={file_id}'
-            gdown.download(url, model_path, quiet=False)
-        else:
-            print("Inswapper modeli mevcut.")
-        
-        self.swapper = insightface.model_zoo.get_model(model_path, download=False, download_zip=False)
+        if self.is_initialized:
+            return self.det_model, self.rec_model, self.swapper
+        
+        buffalo_dir, model_path = download_models()
+        
+        # Oturumlar doğrudan sınırlı thread'li ayarlarla açılır. Swapper sadece
+        # algılama ve ArcFace embedding'ine ihtiyaç duyduğu için buffalo_l'deki
+        # landmark ve genderage modelleri yüklenmez
+        providers = get_execution_providers()
+        det_path = os.path.join(buffalo_dir, DET_MODEL_FILE)
+        self.det_model = RetinaFace(model_file=det_path, session=create_session(det_path, providers))
+        self.det_model.prepare(ctx_id=0, input_size=DET_SIZE, det_thresh=0.5)
+        
+        rec_path = os.path.join(buffalo_dir, REC_MODEL_FILE)
+        self.rec_model = ArcFaceONNX(model_file=rec_path, session=create_session(rec_path, providers))
+        self.rec_model.prepare(ctx_id=0)
+        
+        self.swapper = INSwapper(model_file=model_path, session=create_session(model_path, providers))
+        
+        self._warm_up()
         self.is_initialized = True
         
-        return self.app, self.swapper
+        return self.det_model, self.rec_model, self.swapper
+    
+    def _warm_up(self):
+        """
+        Boş bir resimle tüm ONNX Runtime oturumlarını ısıt. Boş resimde yüz
+        bulunmadığı için recognition ve swapper sabit landmark'lı sahte bir
+        yüzle ayrıca çalıştırılır.
+        """
+        img = np.zeros((*DET_SIZE, 3), dtype=np.uint8)
+        self._detect_face(img)
+        
+        # ArcFace 112x112 hizalama şablonu, resmin ortasına 4 kat büyütülmüş
+        kps = np.array([
+            [38.2946, 51.6963],
+            [73.5318, 51.5014],
+            [56.0252, 71.7366],
+            [41.5493, 92.3655],
+            [70.7299, 92.2041],
+        ], dtype=np.float32) * 4 + 96
+        face = Face(bbox=np.array([96, 96, 544, 544], dtype=np.float32), kps=kps, det_score=1.0)
+        self.rec_model.get(img, face)
+        self.swapper.get(img, face, face, paste_back=True)
     
     def face_swap_function(self, source_image_base64, target_image_base64, display_results=True):
         """
@@ -44,53 +148,153 @@ class FaceSwapProcessor:
         Returns:
             str: Base64 formatında kodlanmış sonuç resmi
         """
+        # Resmi base64 formatına çevir
+        jpeg_bytes = self.face_swap_jpeg(source_image_base64, target_image_base64, is_base64=True)
+        return pybase64.b64encode_as_string(jpeg_bytes)
+    
+    def face_swap_bytes(self, source_image_bytes, target_image_bytes):
+        """
+        face_swap_function ile aynı işi yapar, ancak resimleri base64 yerine
+        ham dosya byte'ları olarak alır (multipart yüklemeler için)
+        
+        Args:
+            source_image_bytes (bytes): Kaynak resim dosyası (yüzü alınacak resim)
+            target_image_bytes (bytes): Hedef resim dosyası (yüzün yerleştirileceği resim)
+        
+        Returns:
+            str: Base64 formatında kodlanmış sonuç resmi
+        """
+        jpeg_bytes = self.face_swap_jpeg(source_image_bytes, target_image_bytes, is_base64=False)
+        return pybase64.b64encode_as_string(jpeg_bytes)
+    
+    def face_swap_jpeg(self, source_image, target_image, is_base64=True):
+        """
+        Face swap yapar ve sonucu base64'e çevirmeden JPEG byte'ları olarak
+        döndürür (binary callback'ler için)
+        
+        Args:
+            source_image (str | bytes): Kaynak resim (yüzü alınacak resim)
+            target_image (str | bytes): Hedef resim (yüzün yerleştirileceği resim)
+            is_base64 (bool): Resimler base64 ise True, ham dosya byte'ları ise False
+        
+        Returns:
+            bytes: JPEG formatında sonuç resmi
+        """
         if not self.is_initialized:
             self.initialize_face_swap()
         
-        # Base64'ten resimleri decode et
+        source_data = source_image.encode() if is_base64 else source_image
+        source_face = self._prepare_source_face(source_data, is_base64)
+        
+        target_img = self._decode_image(target_image, is_base64, max_size=MAX_TARGET_IMAGE_SIZE)
+        if target_img is None:
+            if is_base64:
+                raise ValueError("Hedef resim base64'ten decode edilemedi!")
+            raise ValueError("Hedef resim decode edilemedi!")
+        
+        result_img = self._swap_face(target_img, source_face)
+        return self._encode_jpeg(result_img)
+    
+    def _decode_image(self, image_data, is_base64, reduced=False, max_size=0):
+        """
+        Resmi BGR numpy dizisine decode eder
+        
+        Args:
+            image_data (str | bytes): Base64 veya ham resim verisi
+            is_base64 (bool): image_data base64 ise True
+            reduced (bool): Yarı çözünürlükte decode et (küçük resimlerde tam çözünürlüğe döner)
+            max_size (int): En uzun kenar bunu aşarsa resim orantılı olarak küçültülür (0: sınırsız)
+        
+        Returns:
+            np.ndarray | None: Decode edilen resim, decode edilemezse None
+        """
         try:
-            # Base64 string'i byte array'e çevir
-            source_img_data = base64.b64decode(source_image_base64)
-            target_img_data = base64.b64decode(target_image_base64)
-            
-            # Byte array'i numpy array'e çevir
-            source_nparr = np.frombuffer(source_img_data, np.uint8)
-            target_nparr = np.frombuffer(target_img_data, np.uint8)
-            
-            # OpenCV ile decode et
-            source_img = cv2.imdecode(source_nparr, cv2.IMREAD_COLOR)
-            target_img = cv2.imdecode(target_nparr, cv2.IMREAD_COLOR)
+            if is_base64:
+                image_data = pybase64.b64decode(image_data, validate=False)
+            nparr = np.frombuffer(image_data, np.uint8)
             
+            if reduced:
+                img = cv2.imdecode(nparr, cv2.IMREAD_REDUCED_COLOR_2)
+                if img is not None and max(img.shape[:2]) < DET_SIZE[0]:
+                    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            else:
+                img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         except Exception as e:
-            raise ValueError(f"Base64 decode hatası: {str(e)}")
+            if is_base64:
+                raise ValueError(f"Base64 decode hatası: {str(e)}")
+            raise ValueError(f"Resim decode hatası: {str(e)}")
+        
+        # Çok büyük resimleri küçült; algılama zaten DET_SIZE'da yapıldığı
+        # için sonraki tüm adımların bellek trafiğini azaltır
+        if img is not None and max_size > 0 and max(img.shape[:2]) > max_size:
+            scale = max_size / max(img.shape[:2])
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return img
+    
+    def _encode_jpeg(self, img):
+        """Resmi JPEG byte'larına çevirir"""
+        _, buffer = cv2.imencode('.jpg', img, JPEG_ENCODE_PARAMS)
+        return buffer.tobytes()
+    
+    def _prepare_source_face(self, source_data, is_base64):
+        """
+        Kaynak resmi decode edip ilk yüzü döndürür. Aynı kaynak resim birçok
+        istekte tekrar kullanıldığı için sonuç, girdi byte'larının BLAKE3
+        özetiyle önbelleğe alınır.
+        """
+        cache_key = blake3(source_data).digest()
+        with self._source_face_lock:
+            source_face = self._source_face_cache.get(cache_key)
+            if source_face is not None:
+                self._source_face_cache.move_to_end(cache_key)
+                return source_face
         
+        # Kaynak resimden sadece yüz embedding'i alındığı için yarı
+        # çözünürlükte decode etmek yeterli
+        source_img = self._decode_image(source_data, is_base64, reduced=True, max_size=MAX_IMAGE_SIZE)
         if source_img is None:
-            raise ValueError("Kaynak resim base64'ten decode edilemedi!")
-        if target_img is None:
-            raise ValueError("Hedef resim base64'ten decode edilemedi!")
-            
-        source_faces = self.app.get(source_img)
-        target_faces = self.app.get(target_img)
+            if is_base64:
+                raise ValueError("Kaynak resim base64'ten decode edilemedi!")
+            raise ValueError("Kaynak resim decode edilemedi!")
         
-        if len(source_faces) == 0:
+        source_face = self._detect_face(source_img)
+        if source_face is None:
             raise ValueError("Kaynak resimde yüz bulunamadı!")
-        if len(target_faces) == 0:
-            raise ValueError("Hedef resimde yüz bulunamadı!")
+        # Swapper kaynak yüzden sadece normed_embedding kullanır
+        self.rec_model.get(source_img, source_face)
         
-        # İlk yüzleri al
-        source_face = source_faces[0]  
-        target_face = target_faces[0]  
+        with self._source_face_lock:
+            self._source_face_cache[cache_key] = source_face
+            if len(self._source_face_cache) > SOURCE_FACE_CACHE_SIZE:
+                self._source_face_cache.popitem(last=False)
         
-        # Face swap işlemi (kaynak yüzü hedef resme yerleştir)
-        print("Face swap işlemi yapılıyor...")
-        result_img = target_img.copy()
+        return source_face
+    
+    def _detect_face(self, img):
+        """
+        Resimdeki en yüksek skorlu yüzü sadece algılama modeliyle bulur
         
-        # Kaynak yüzü hedef resme yerleştir
-        result_img = self.swapper.get(result_img, target_face, source_face, paste_back=True)
+        Returns:
+            Face | None: bbox ve kps içeren yüz, yüz yoksa None
+        """
+        bboxes, kpss = self.det_model.detect(img, input_size=DET_SIZE)
+        if bboxes.shape[0] == 0:
+            return None
+        kps = kpss[0] if kpss is not None else None
+        return Face(bbox=bboxes[0, 0:4], kps=kps, det_score=bboxes[0, 4])
+    
+    def _swap_face(self, target_img, source_face):
+        """Kaynak yüzü hedef resimdeki ilk yüzün yerine yerleştirir"""
+        # Swapper hedef yüzden sadece hizalama için kps kullanır; embedding
+        # gereksiz
+        target_face = self._detect_face(target_img)
+        if target_face is None:
+            raise ValueError("Hedef resimde yüz bulunamadı!")
         
-        # Resmi base64 formatına çevir
-        _, buffer = cv2.imencode('.jpg', result_img)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
+        # Face swap işlemi (kaynak yüzü hedef resme yerleştir)
+        print("Face swap işlemi yapılıyor...")
         
-        return img_base64
+        # paste_back=True yeni bir resim döndürdüğü ve hedef resmi
+        # değiştirmediği için kopyaya gerek yok
+        return self.swapper.get(target_img, target_face, source_face, paste_back=True)
         
\ No newline at end of file
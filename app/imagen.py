@@ -1,8 +1,6 @@
 from vertexai.preview.vision_models import ImageGenerationModel
 import vertexai
-import base64
-import os
-import tempfile
+import pybase64
 
 class ImagenGenerator:
     """Class for generating images using Google's Imagen model"""
@@ -71,21 +69,10 @@ class ImagenGenerator:
             add_watermark=True,
         )
         
-        # Save to temporary file and convert to base64
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-            output_file = tmp_file.name
-            images[0].save(location=output_file, include_generation_parameters=False)
-        
-        # Read and encode to base64
-        with open(output_file, "rb") as image_file:
-            image_bytes = image_file.read()
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        
-        # Clean up temporary file
-        try:
-            os.remove(output_file)
-        except:
-            pass
+        # Encode the generated bytes directly; save() without generation
+        # parameters would only write these same bytes to disk
+        image_bytes = images[0]._image_bytes
+        image_base64 = pybase64.b64encode_as_string(image_bytes)
         
         print("Image generated successfully")
         return image_base64
\ No newline at end of file
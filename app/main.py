@@ -1,19 +1,26 @@
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, BackgroundTasks, File, Form, UploadFile
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import httpx
+import orjson
+import pybase64
 import uuid
 import asyncio
 import os
-from face_swapper import FaceSwapProcessor
+from urllib.parse import quote
+from face_swapper import FaceSwapProcessor, download_models, WORKERS
 from imagen import ImagenGenerator
 
 app = FastAPI(title="Test Image Generation and Face Swap API", 
-              description="API for generating test images with Imagen and swapping faces asynchronously with webhook callbacks")
+              description="API for generating test images with Imagen and swapping faces asynchronously with webhook callbacks",
+              default_response_class=ORJSONResponse)
 
 # Configuration - Use environment variables for Cloud Run
 CALLBACK_API_URL = os.environ.get("CALLBACK_API_URL", "http://127.0.0.1:8000/callback")
+CALLBACK_BINARY_API_URL = os.environ.get("CALLBACK_BINARY_API_URL", "http://127.0.0.1:8000/callback/face-swap/binary")
 PORT = int(os.environ.get("PORT", 8001))
 HOST = os.environ.get("HOST", "127.0.0.1")
+MAX_CONCURRENT_SWAPS = int(os.environ.get("MAX_CONCURRENT_SWAPS", 2))
 
 class TestImageRequest(BaseModel):
     """Request model for test image generation and face swap operation"""
@@ -37,6 +44,7 @@ class FaceSwapRequest(BaseModel):
     source_image_base64: str
     target_image_base64: str
     callback_url: str | None = None  # Optional callback URL parameter
+    binary_callback: bool = False  # Send the result as raw JPEG bytes instead of base64 JSON
 
 class TestImageResult(BaseModel):
     """Result model for test image generation and face swap operation"""
@@ -57,6 +65,26 @@ class FaceSwapResult(BaseModel):
 face_swapper_instance = FaceSwapProcessor()
 imagen_generator_instance = ImagenGenerator()
 
+# Caps in-flight face swaps per worker so bursts of multi-MB images don't exhaust memory
+swap_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SWAPS)
+
+# Shared HTTP client so callbacks reuse pooled keep-alive connections
+http_client = httpx.AsyncClient(
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+)
+
+@app.on_event("startup")
+async def load_models():
+    """Load and warm up models before the first request arrives"""
+    face_swapper_instance.initialize_face_swap()
+    imagen_generator_instance.initialize()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """Close pooled callback connections"""
+    await http_client.aclose()
+
 async def process_test_image_and_callback(payload: TestImageRequest, request_id: str):
     """Process test image generation, face swap, and send results to callback URL"""
     print(f"Background task started for test image request ID: {request_id}")
@@ -66,7 +94,8 @@ async def process_test_image_and_callback(payload: TestImageRequest, request_id:
         print(f"Starting image generation for request ID: {request_id}")
         
         # Step 1: Generate image using Imagen based on test data
-        generated_image_base64 = imagen_generator_instance.generate_image_from_test(
+        generated_image_base64 = await asyncio.to_thread(
+            imagen_generator_instance.generate_image_from_test,
             test_sonucu=payload.test_sonucu,
             test_adı=payload.test_adı,
             test_aciklamasi=payload.test_aciklamasi,
@@ -79,10 +108,12 @@ async def process_test_image_and_callback(payload: TestImageRequest, request_id:
         
         # Step 2: Perform face swap - swap source face onto generated image
         print(f"Starting face swap for request ID: {request_id}")
-        swapped_image_base64 = face_swapper_instance.face_swap_function(
-            source_image_base64=payload.source_face_image_base64,
-            target_image_base64=generated_image_base64
-        )
+        async with swap_semaphore:
+            swapped_image_base64 = await asyncio.to_thread(
+                face_swapper_instance.face_swap_function,
+                source_image_base64=payload.source_face_image_base64,
+                target_image_base64=generated_image_base64
+            )
         print(f"Face swap completed successfully for request ID: {request_id}")
         
         result = TestImageResult(
@@ -103,48 +134,88 @@ async def process_test_image_and_callback(payload: TestImageRequest, request_id:
 
     # Send result to callback URL
     print(f"Sending callback to {callback_url} for request ID: {request_id}")
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            json_response = await client.post(callback_url, json=result.model_dump())
-            print(f"Callback sent successfully to {callback_url}. Status: {json_response.status_code}")
-        except Exception as callback_error:
-            print(f"Failed to send callback to {callback_url}: {callback_error}, request_id: {request_id}")
-
-async def process_face_swap_and_callback(payload: FaceSwapRequest, request_id: str):
-    """Process face swap only and send results to callback URL"""
+    try:
+        json_response = await http_client.post(
+            callback_url,
+            content=orjson.dumps(result.model_dump()),
+            headers={"Content-Type": "application/json"}
+        )
+        print(f"Callback sent successfully to {callback_url}. Status: {json_response.status_code}")
+    except Exception as callback_error:
+        print(f"Failed to send callback to {callback_url}: {callback_error}, request_id: {request_id}")
+
+async def process_face_swap_and_callback(
+    source_image,
+    target_image,
+    is_base64: bool,
+    callback_url: str | None,
+    request_id: str,
+    binary_callback: bool = False
+):
+    """
+    Process face swap only and send results to callback URL.
+    
+    Images are base64 strings for JSON requests and raw file bytes for
+    uploads. With binary_callback the swapped JPEG is posted as the raw
+    request body, with status and request ID in headers.
+    """
     print(f"Background task started for face swap request ID: {request_id}")
-    callback_url = payload.callback_url or CALLBACK_API_URL
+    if binary_callback:
+        callback_url = callback_url or CALLBACK_BINARY_API_URL
+    else:
+        callback_url = callback_url or CALLBACK_API_URL
     
+    jpeg_bytes = b""
+    error = None
     try:
         print(f"Starting face swap processing for request ID: {request_id}")
         
-        # Perform face swap
-        swapped_base64 = face_swapper_instance.face_swap_function(
-            payload.source_image_base64, payload.target_image_base64
-        )
+        # Perform face swap in a worker thread so the event loop stays responsive
+        async with swap_semaphore:
+            jpeg_bytes = await asyncio.to_thread(
+                face_swapper_instance.face_swap_jpeg, source_image, target_image, is_base64
+            )
         print(f"Face swap completed successfully for request ID: {request_id}")
-        result = FaceSwapResult(
-            status="success", 
-            swapped_image_base64=swapped_base64, 
-            request_id=request_id
-        )
     except Exception as e:
         print(f"Face swap failed for request ID: {request_id}, error: {str(e)}")
-        result = FaceSwapResult(
-            status="failed", 
-            swapped_image_base64="", 
-            request_id=request_id, 
-            error=str(e)
-        )
+        error = str(e)
+
+    if binary_callback:
+        headers = {
+            "X-Status": "failed" if error else "success",
+            "X-Request-Id": request_id
+        }
+        if error:
+            # No body on failure; header values must be ASCII
+            headers["X-Error"] = quote(error)
+            content = b""
+        else:
+            headers["Content-Type"] = "image/jpeg"
+            content = jpeg_bytes
+    else:
+        if error:
+            result = FaceSwapResult(
+                status="failed", 
+                swapped_image_base64="", 
+                request_id=request_id, 
+                error=error
+            )
+        else:
+            result = FaceSwapResult(
+                status="success", 
+                swapped_image_base64=pybase64.b64encode_as_string(jpeg_bytes), 
+                request_id=request_id
+            )
+        headers = {"Content-Type": "application/json"}
+        content = orjson.dumps(result.model_dump())
 
     # Send result to callback URL
     print(f"Sending callback to {callback_url} for request ID: {request_id}")
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            json_response = await client.post(callback_url, json=result.model_dump())
-            print(f"Callback sent successfully to {callback_url}. Status: {json_response.status_code}")
-        except Exception as callback_error:
-            print(f"Failed to send callback to {callback_url}: {callback_error}, request_id: {request_id}")
+    try:
+        json_response = await http_client.post(callback_url, content=content, headers=headers)
+        print(f"Callback sent successfully to {callback_url}. Status: {json_response.status_code}")
+    except Exception as callback_error:
+        print(f"Failed to send callback to {callback_url}: {callback_error}, request_id: {request_id}")
 
 @app.get("/health")
 async def health_check():
@@ -161,7 +232,7 @@ async def process_test_image(payload: TestImageRequest, background_tasks: Backgr
     2. Swaps the provided face onto the generated image
     3. Sends results to the callback URL
     """
-    request_id = str(uuid.uuid4())
+    request_id = uuid.uuid4().hex
     
     print(f"Test image request received with ID: {request_id}")
     print("Adding background task for test image processing...")
@@ -180,11 +251,55 @@ async def process_face_swap_endpoint(payload: FaceSwapRequest, background_tasks:
     
     This endpoint performs face swap between two provided images.
     """
-    request_id = str(uuid.uuid4())
+    request_id = uuid.uuid4().hex
     
     print(f"Face swap request received with ID: {request_id}")
     print("Adding background task for face swap...")
-    background_tasks.add_task(process_face_swap_and_callback, payload, request_id)
+    background_tasks.add_task(
+        process_face_swap_and_callback,
+        payload.source_image_base64,
+        payload.target_image_base64,
+        is_base64=True,
+        callback_url=payload.callback_url,
+        request_id=request_id,
+        binary_callback=payload.binary_callback
+    )
+    
+    print(f"Returning immediate response for request ID: {request_id}")
+    return {
+        "message": "Request received. Face swap processing will continue in background.", 
+        "request_id": request_id
+    }
+
+@app.post("/process-face-swap/upload")
+async def process_face_swap_upload_endpoint(
+    background_tasks: BackgroundTasks,
+    source_image: UploadFile = File(...),
+    target_image: UploadFile = File(...),
+    callback_url: str | None = Form(None),
+    binary_callback: bool = Form(False)
+):
+    """
+    Multipart variant of /process-face-swap.
+    
+    Images are uploaded as raw files, which skips the base64 decode and
+    avoids parsing multi-megabyte JSON bodies.
+    """
+    request_id = uuid.uuid4().hex
+    source_bytes = await source_image.read()
+    target_bytes = await target_image.read()
+    
+    print(f"Face swap upload request received with ID: {request_id}")
+    print("Adding background task for face swap...")
+    background_tasks.add_task(
+        process_face_swap_and_callback,
+        source_bytes,
+        target_bytes,
+        is_base64=False,
+        callback_url=callback_url,
+        request_id=request_id,
+        binary_callback=binary_callback
+    )
     
     print(f"Returning immediate response for request ID: {request_id}")
     return {
@@ -196,4 +311,7 @@ if __name__ == "__main__":
     import uvicorn
     print(f"Starting Test Image and Face Swap API on {HOST}:{PORT}")
     print(f"Callback URL: {CALLBACK_API_URL}")
-    uvicorn.run(app, host=HOST, port=PORT)
+    # Download model files once here so workers don't race on the same paths;
+    # each worker then loads its own copy via the startup hook
+    download_models()
+    uvicorn.run("main:app", host=HOST, port=PORT, workers=WORKERS)